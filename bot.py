@@ -1,36 +1,63 @@
+import asyncio
 import json
 import logging
 import os
-import psycopg2
-from psycopg2.extras import RealDictCursor
-import re
+import asyncpg
+import secrets
+from typing import Optional
+from cachetools import TTLCache
+from search_utils import normalize_query
+try:
+    import uvloop
+except ImportError:  # uvloop is not available on Windows
+    uvloop = None
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, CallbackContext
+from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters, ContextTypes, CallbackContext
+
+# Load configuration
+with open('config.json', 'r') as f:
+    config = json.load(f)
 
 # Configure logging
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=config.get('log_level', 'INFO')
 )
+# httpx logs every polling request at INFO level
+logging.getLogger('httpx').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
-# Load configuration
-with open('config.json', 'r') as f:
-    config = json.load(f)
+# In-memory storage for pictures waiting for a description
+# Structure: {message_id: {'file_id': file_id, 'chat_id': chat_id}}
+# Bounded so that pictures which never get a description don't pile up forever
+picture_memory = TTLCache(maxsize=10_000, ttl=86_400)
 
-# Database connection
-def get_db_connection():
-    return psycopg2.connect(
-        host=config['database']['host'],
-        port=config['database']['port'],
-        user=config['database']['user'],
-        password=config['database']['password'],
-        database=config['database']['database']
-    )
+# SQL statements, built once and kept on a single line
+SEARCH_SQL = "SELECT file_id, description FROM search_memes($1, $2)"
+UPSERT_SQL = "INSERT INTO memes (file_id, description) VALUES ($1, $2) ON CONFLICT (file_id) DO UPDATE SET description = EXCLUDED.description"
 
-# In-memory storage for pictures
-# Structure: {message_id: {'file_id': file_id, 'chat_id': chat_id}}
-picture_memory = {}
+# Number of matches fetched per search and offered through "Show more results"
+SEARCH_RESULTS_LIMIT = 10
+
+# Recent search results, so repeated searches don't hit the database
+# Structure: {search_query: results}
+search_cache = TTLCache(maxsize=1024, ttl=60)
+
+# Bumped after every save, results of searches started before it aren't cached
+search_generation = 0
+
+# Searches currently running in the database, shared by concurrent identical searches
+# Structure: {search_query: task}
+search_inflight = {}
+
+# Results of searches that can still be paged with "Show more results"
+# Structure: {token: results}, the token is passed in the button's callback data
+search_pages = TTLCache(maxsize=10_000, ttl=600)
+
+# Descriptions are written to the database in batches of up to
+# SAVE_BATCH_SIZE rows, waiting at most SAVE_BATCH_DELAY seconds to fill one
+SAVE_BATCH_SIZE = 100
+SAVE_BATCH_DELAY = 0.2
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
@@ -44,99 +71,232 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         'Send me a text query and I will find the best matching meme for you.'
     )
 
-async def monitor_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Monitor the target group for pictures and descriptions."""
-    # Check if the message is from the target group
-    if update.effective_chat.username != config['target_group_username']:
+async def store_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Remember a picture posted in the target group until its description arrives."""
+    file_id = update.message.photo[-1].file_id  # Get the largest photo
+    picture_memory[update.message.message_id] = {
+        'file_id': file_id,
+        'chat_id': update.effective_chat.id
+    }
+    logger.debug("Stored photo with message_id %s", update.message.message_id)
+
+async def save_description(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Save the description the bot replied with together with its picture."""
+    # Take the picture out of memory, a single lookup instead of check + get + delete
+    reply_id = update.message.reply_to_message.message_id
+    picture_data = picture_memory.pop(reply_id, None)
+    if picture_data is None:
         return
+    description = update.message.text
     
-    # Check if the message contains a photo
-    if update.message.photo:
-        # Store the photo in memory
-        file_id = update.message.photo[-1].file_id  # Get the largest photo
-        picture_memory[update.message.message_id] = {
-            'file_id': file_id,
-            'chat_id': update.effective_chat.id
-        }
-        logger.info(f"Stored photo with message_id {update.message.message_id}")
-    
-    # Check if the message is a reply from the bot with a description
-    elif (update.message.from_user.username == config['bot_username'] and 
-          update.message.reply_to_message and 
-          update.message.reply_to_message.message_id in picture_memory):
+    # Queue for saving, the save worker writes it to the database
+    context.bot_data['save_queue'].put_nowait((reply_id, picture_data, description))
+    logger.debug("Queued meme with description: %.50s...", description)
+
+async def save_memes(db_pool: asyncpg.Pool, batch: list) -> None:
+    """Save a batch of (message_id, picture_data, description) entries to the database."""
+    global search_generation
+    # A later description of the same picture replaces an earlier one
+    rows = list({picture_data['file_id']: description for _, picture_data, description in batch}.items())
+    try:
+        await db_pool.executemany(UPSERT_SQL, rows)
+        logger.info("Saved %d meme(s) to the database", len(rows))
+        # New memes may change the results of any search, including running ones
+        search_generation += 1
+        search_cache.clear()
+        search_inflight.clear()
+    except Exception:
+        logger.exception("Error saving %d meme(s) to database", len(rows))
+        # Put the pictures back so that a later description can still be saved
+        for message_id, picture_data, _ in batch:
+            picture_memory[message_id] = picture_data
+
+async def save_worker(application: Application) -> None:
+    """Drain the save queue in batches until a None sentinel is received."""
+    queue = application.bot_data['save_queue']
+    loop = asyncio.get_running_loop()
+    running = True
+    while running:
+        item = await queue.get()
+        if item is None:
+            break
+        batch = [item]
         
-        # Get the picture from memory
-        picture_data = picture_memory[update.message.reply_to_message.message_id]
-        file_id = picture_data['file_id']
-        description = update.message.text
+        # Collect more rows until the batch is full or the delay runs out
+        deadline = loop.time() + SAVE_BATCH_DELAY
+        while len(batch) < SAVE_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if item is None:
+                running = False
+                break
+            batch.append(item)
         
-        # Save to database
-        try:
-            conn = get_db_connection()
-            with conn.cursor() as cur:
-                cur.execute(
-                    "INSERT INTO memes (file_id, description) VALUES (%s, %s) ON CONFLICT (file_id) DO UPDATE SET description = %s",
-                    (file_id, description, description)
-                )
-            conn.commit()
-            conn.close()
-            logger.info(f"Saved meme with description: {description[:50]}...")
-            
-            # Remove from memory to free up space
-            del picture_memory[update.message.reply_to_message.message_id]
-        except Exception as e:
-            logger.error(f"Error saving to database: {e}")
+        await save_memes(application.bot_data['db'], batch)
+
+async def query_results(db_pool: asyncpg.Pool, search_query: str) -> list:
+    """Run the search query in the database and cache the results."""
+    generation = search_generation
+    results = await db_pool.fetch(SEARCH_SQL, search_query, SEARCH_RESULTS_LIMIT)
+    # A save during the query may have made these results stale
+    if generation == search_generation:
+        search_cache[search_query] = results
+    return results
+
+def forget_search(search_query: str, task: asyncio.Task) -> None:
+    """Remove a finished search from search_inflight unless it was replaced."""
+    if search_inflight.get(search_query) is task:
+        del search_inflight[search_query]
+
+async def fetch_results(db_pool: asyncpg.Pool, search_query: str) -> list:
+    """Fetch the best matches for the query."""
+    results = search_cache.get(search_query)
+    if results is not None:
+        return results
+    
+    # Join the same search if another user is already running it
+    task = search_inflight.get(search_query)
+    if task is None:
+        task = asyncio.create_task(query_results(db_pool, search_query))
+        search_inflight[search_query] = task
+        task.add_done_callback(lambda done: forget_search(search_query, done))
+    
+    # Shielded so that one cancelled caller doesn't cancel the search for the others
+    return await asyncio.shield(task)
+
+async def reply_with_result(message, results: list, index: int, token: Optional[str]) -> None:
+    """Reply with the result at index and a button for the next one."""
+    file_id, description = results[index]
+    reply_markup = None
+    if index + 1 < len(results):
+        reply_markup = InlineKeyboardMarkup([
+            [InlineKeyboardButton("Show more results", callback_data=f"more:{token}:{index + 1}")]
+        ])
+    
+    await message.reply_photo(
+        photo=file_id,
+        caption=f"Match: {description[:200]}...",
+        reply_markup=reply_markup
+    )
 
 async def search_meme(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Search for memes based on user query."""
     query = update.message.text
     
     # Clean the query for full-text search
-    # Replace special characters with spaces and convert to lowercase
-    clean_query = re.sub(r'[^\w\s]', ' ', query.lower())
-    # Convert spaces to '&' for tsquery
-    ts_query = ' & '.join(clean_query.split())
+    search_query = normalize_query(query)
+    if not search_query:
+        await update.message.reply_text("No matching memes found.")
+        return
     
     try:
-        conn = get_db_connection()
-        with conn.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT * FROM search_memes(%s)", (ts_query,))
-            results = cur.fetchall()
-        conn.close()
+        results = await fetch_results(context.bot_data['db'], search_query)
         
         if results:
+            # Keep the results so the other matches can be shown without searching again
+            token = None
+            if len(results) > 1:
+                token = secrets.token_urlsafe(8)
+                search_pages[token] = results
+            
             # Send the top result
-            best_match = results[0]
-            await update.message.reply_photo(
-                photo=best_match['file_id'],
-                caption=f"Match: {best_match['description'][:200]}...",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("Show more results", callback_data=f"more_{query}")]
-                ]) if len(results) > 1 else None
-            )
+            await reply_with_result(update.message, results, 0, token)
         else:
             await update.message.reply_text("No matching memes found.")
-    except Exception as e:
-        logger.error(f"Error searching database: {e}")
+    except Exception:
+        logger.exception("Error searching database")
         await update.message.reply_text("An error occurred while searching. Please try again later.")
 
+async def show_more(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Send the next search result when "Show more results" is pressed."""
+    callback_query = update.callback_query
+    await callback_query.answer()
+    
+    _, token, index = callback_query.data.split(':')
+    results = search_pages.get(token)
+    if results is None:
+        await callback_query.message.reply_text("This search has expired, please search again.")
+        return
+    
+    await reply_with_result(callback_query.message, results, int(index), token)
+
+async def post_init(application: Application) -> None:
+    """Create the database connection pool once the event loop is running."""
+    db_config = config['database']
+    application.bot_data['db'] = await asyncpg.create_pool(
+        min_size=db_config.get('min_size', 2),
+        max_size=db_config.get('max_size', 10),
+        max_inactive_connection_lifetime=db_config.get('max_inactive_connection_lifetime', 300),
+        statement_cache_size=db_config.get('statement_cache_size', 1024),
+        command_timeout=db_config.get('command_timeout', 10),
+        host=db_config['host'],
+        port=db_config['port'],
+        user=db_config['user'],
+        password=db_config['password'],
+        database=db_config['database']
+    )
+    application.bot_data['save_queue'] = asyncio.Queue()
+    application.bot_data['save_task'] = asyncio.create_task(save_worker(application))
+
+async def post_shutdown(application: Application) -> None:
+    """Flush pending saves and close the database connection pool."""
+    save_task = application.bot_data.pop('save_task', None)
+    if save_task is not None:
+        await application.bot_data['save_queue'].put(None)
+        await save_task
+    
+    db_pool = application.bot_data.pop('db', None)
+    if db_pool is not None:
+        await db_pool.close()
+
 def main() -> None:
     """Start the bot."""
+    # Run the event loop on libuv when possible, it dispatches I/O callbacks faster
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    
     # Create the Application
-    application = Application.builder().token(config['bot_token']).build()
+    # Updates are handled concurrently, so a slow search doesn't hold up the others
+    application = (
+        Application.builder()
+        .token(config['bot_token'])
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # Add handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
     
-    # Monitor the target group for pictures and descriptions
-    application.add_handler(MessageHandler(filters.ALL, monitor_group))
+    # Monitor the target group for pictures and the bot's replies with descriptions
+    # The filters are built once here, matching by chat id is cheaper than by username
+    if 'target_group_id' in config:
+        group_filter = filters.Chat(chat_id=int(config['target_group_id']))
+    else:
+        group_filter = filters.Chat(username=config['target_group_username'])
+    # Only new messages are handled, edits don't set update.message
+    group_filter = group_filter & filters.UpdateType.MESSAGE
+    application.add_handler(MessageHandler(group_filter & filters.PHOTO, store_photo))
+    application.add_handler(MessageHandler(
+        group_filter & filters.REPLY & filters.TEXT & filters.User(username=config['bot_username']),
+        save_description
+    ))
     
     # Handle direct messages to the bot for search
     application.add_handler(MessageHandler(
-        filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, 
+        filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE & filters.UpdateType.MESSAGE, 
         search_meme
     ))
+    
+    # Handle the "Show more results" button
+    application.add_handler(CallbackQueryHandler(show_more, pattern=r'^more:'))
 
     # Run the bot until the user presses Ctrl-C
     application.run_polling()
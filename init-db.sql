@@ -14,8 +14,15 @@ CREATE TABLE IF NOT EXISTS memes (
 CREATE INDEX IF NOT EXISTS idx_memes_ts_description ON memes USING GIN (ts_description);
 CREATE INDEX IF NOT EXISTS idx_memes_description_trgm ON memes USING GIN (description gin_trgm_ops);
 
--- Function to search memes by description
-CREATE OR REPLACE FUNCTION search_memes(search_query TEXT)
+-- Function to search memes by description, returning the best matches
+-- The query is parsed with plainto_tsquery using the same 'english' config
+-- as ts_description, so the GIN index on that column can be used
+-- Drop the original one-argument signature so that calls aren't ambiguous
+DROP FUNCTION IF EXISTS search_memes(TEXT);
+CREATE OR REPLACE FUNCTION search_memes(
+    search_query TEXT,
+    result_limit INTEGER DEFAULT 10
+)
 RETURNS TABLE (
     id INTEGER,
     file_id VARCHAR(255),
@@ -23,6 +30,8 @@ RETURNS TABLE (
     created_at TIMESTAMP WITH TIME ZONE,
     rank FLOAT
 ) AS $$
+DECLARE
+    ts_query TSQUERY := plainto_tsquery('english', search_query);
 BEGIN
     RETURN QUERY
     SELECT
@@ -30,15 +39,34 @@ BEGIN
         m.file_id,
         m.description,
         m.created_at,
-        ts_rank(m.ts_description, to_tsquery('english', search_query)) +
-        similarity(m.description, search_query) AS rank
+        ts_rank_cd(m.ts_description, ts_query)::FLOAT AS rank
     FROM
         memes m
     WHERE
-        m.ts_description @@ to_tsquery('english', search_query) OR
-        m.description % search_query
+        m.ts_description @@ ts_query
     ORDER BY
         rank DESC
-    LIMIT 10;
+    LIMIT result_limit;
+    
+    IF NOT FOUND THEN
+        -- Nothing matched the words exactly (e.g. a typo), fall back to
+        -- trigram word similarity, which uses idx_memes_description_trgm
+        RETURN QUERY
+        SELECT
+            m.id,
+            m.file_id,
+            m.description,
+            m.created_at,
+            word_similarity(search_query, m.description)::FLOAT AS rank
+        FROM
+            memes m
+        WHERE
+            search_query <% m.description
+        ORDER BY
+            rank DESC
+        LIMIT result_limit;
+    END IF;
 END;
-$$ LANGUAGE plpgsql;
+$$ LANGUAGE plpgsql
+-- Low enough that one-letter typos in short words still match
+SET pg_trgm.word_similarity_threshold = 0.3;
@@ -0,0 +1,10 @@
+import re
+from functools import lru_cache
+
+# Runs of special characters, replaced with a single space in search queries
+PUNCTUATION_RE = re.compile(r'[^\w\s]+')
+
+@lru_cache(maxsize=4096)
+def normalize_query(query: str) -> str:
+    """Lowercase the query and replace special characters with spaces."""
+    return ' '.join(PUNCTUATION_RE.sub(' ', query.lower()).split())